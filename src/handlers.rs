@@ -4,10 +4,11 @@ use std::str;
 use std::str::FromStr;
 use std::sync::Arc;
 
-use hyper::header::LOCATION;
+use hyper::header::{ACCEPT, AUTHORIZATION, CONTENT_LENGTH, CONTENT_TYPE, LOCATION};
 use hyper::{Body, Method, Request, Response, StatusCode};
 
 use serde::{Deserialize, Serialize};
+use serde_json;
 
 use crate::cards::Card;
 use crate::game_manager::GameManager;
@@ -36,6 +37,28 @@ pub async fn missingparts_service(
                                 .unwrap());
     };
 
+    if rich_parts.does_match(&Method::POST, "/batch") {
+        let body: Result<BatchRequest, BodyParseError> = rich_parts
+            .deserialize_by_content_type(body, 16 * 1024)
+            .await;
+        match body {
+            Ok(body) => Ok(process_batch(body, &response_mime_type, lobby, game_manager).await),
+            Err(e) => Ok(e.into()),
+        }
+    } else {
+        route(rich_parts, body, response_mime_type, lobby, game_manager).await
+    }
+}
+
+/// Handles all the requests except for `/batch`, so that batches can be processed by calling this for each request in
+/// the batch.
+async fn route(
+    rich_parts: RichParts,
+    body: Body,
+    response_mime_type: SupportedMimeType,
+    lobby: Arc<Lobby>,
+    game_manager: Arc<GameManager>,
+) -> Result<Response<Body>, Infallible> {
     if rich_parts.does_match(&Method::POST, "/lobby") {
         let body: Result<JoinLobbyRequest, BodyParseError> =
             rich_parts.deserialize_by_content_type(body, 1024).await;
@@ -120,7 +143,7 @@ pub async fn missingparts_service(
                         match move_result {
                             Ok(_) => Ok(Response::builder()
                                 .status(StatusCode::OK)
-                                .body(Body::empty())
+                                .body(response_mime_type.serialize(&g.describe()))
                                 .unwrap()),
                             Err(action_error) => Ok(Response::builder()
                                 .status(StatusCode::BAD_REQUEST)
@@ -258,6 +281,134 @@ fn process_get_lobby_player(
     }
 }
 
+/// Processes each request in the batch in order, as if they were sent one by one, and collects their responses in the
+/// same order. The requests in the batch always use JSON; only the batch response itself respects the Accept header.
+async fn process_batch(
+    batch: BatchRequest,
+    response_mime_type: &SupportedMimeType,
+    lobby: Arc<Lobby>,
+    game_manager: Arc<GameManager>,
+) -> Response<Body> {
+    let mut responses = Vec::with_capacity(batch.requests.len());
+    for sub_request in batch.requests {
+        responses.push(
+            process_batch_sub_request(sub_request, Arc::clone(&lobby), Arc::clone(&game_manager))
+                .await,
+        );
+    }
+    Response::builder()
+        .status(StatusCode::OK)
+        .body(response_mime_type.serialize(&BatchResponse { responses }))
+        .unwrap()
+}
+
+async fn process_batch_sub_request(
+    sub_request: BatchSubRequest,
+    lobby: Arc<Lobby>,
+    game_manager: Arc<GameManager>,
+) -> BatchSubResponse {
+    let body = sub_request
+        .body
+        .map(|body| body.to_string())
+        .unwrap_or_default();
+    let req_builder = Request::builder()
+        .method(sub_request.method.as_str())
+        .uri(sub_request.path.as_str())
+        .header(CONTENT_TYPE, "application/json")
+        .header(ACCEPT, "application/json")
+        .header(CONTENT_LENGTH, &format!("{:?}", body.len()));
+    let req_builder = match &sub_request.token {
+        Some(token) => req_builder.header(AUTHORIZATION, token.as_str()),
+        None => req_builder,
+    };
+    let req = match req_builder.body(Body::from(body)) {
+        Ok(req) => req,
+        Err(e) => {
+            return BatchSubResponse {
+                status: StatusCode::BAD_REQUEST.as_u16(),
+                location: None,
+                body: Some(serde_json::Value::String(format!(
+                    "invalid request in batch: {}",
+                    e
+                ))),
+            }
+        }
+    };
+
+    let (parts, body) = req.into_parts();
+    let resp = match route(
+        RichParts::from(&parts),
+        body,
+        SupportedMimeType::Json,
+        lobby,
+        game_manager,
+    )
+    .await
+    {
+        Ok(resp) => resp,
+        Err(infallible) => match infallible {},
+    };
+
+    let status = resp.status().as_u16();
+    let location = resp
+        .headers()
+        .get(LOCATION)
+        .and_then(|h| h.to_str().ok())
+        .map(String::from);
+    let body = match hyper::body::to_bytes(resp.into_body()).await {
+        Ok(body) if body.is_empty() => None,
+        // error responses are not always JSON (for example body parsing errors), so those are returned as strings
+        Ok(body) => Some(
+            serde_json::from_slice::<serde_json::Value>(&body).unwrap_or_else(|_| {
+                serde_json::Value::String(String::from_utf8_lossy(&body).into_owned())
+            }),
+        ),
+        Err(_) => {
+            return BatchSubResponse {
+                status: StatusCode::INTERNAL_SERVER_ERROR.as_u16(),
+                location: None,
+                body: None,
+            }
+        }
+    };
+    BatchSubResponse {
+        status,
+        location,
+        body,
+    }
+}
+
+#[derive(Deserialize)]
+struct BatchRequest {
+    requests: Vec<BatchSubRequest>,
+}
+
+#[derive(Deserialize)]
+struct BatchSubRequest {
+    method: String,
+    path: String,
+    body: Option<serde_json::Value>,
+    token: Option<String>,
+}
+
+#[derive(Serialize)]
+#[cfg_attr(test, derive(Deserialize))]
+struct BatchResponse {
+    responses: Vec<BatchSubResponse>,
+}
+
+#[derive(Serialize)]
+#[cfg_attr(test, derive(Deserialize))]
+struct BatchSubResponse {
+    status: u16,
+
+    #[serde(skip_serializing_if = "Option::is_none")]
+    location: Option<String>,
+
+    #[serde(skip_serializing_if = "Option::is_none")]
+    body: Option<serde_json::Value>,
+}
+
 #[derive(Deserialize)]
 struct JoinLobbyRequest {
     min_game_size: usize,
@@ -299,7 +450,7 @@ mod tests {
     use super::*;
 
     use crate::actionerror::ActionError;
-    use crate::gameplay::GameDescription;
+    use crate::gameplay::{GameDescription, GameState};
 
     use serde::de::DeserializeOwned;
     use serde_json;
@@ -547,6 +698,19 @@ mod tests {
             Some(player.token),
         );
         assert_eq!(resp.status(), StatusCode::OK);
+
+        // the response has the new state of the game, which is now waiting for the same player to finish the scavenge
+        let resp: GameDescription = parse_response(resp);
+        match resp.state {
+            GameState::WaitingForScavengeComplete {
+                player,
+                scavenged_cards,
+            } => {
+                assert_eq!(player, game.player_id_in_game);
+                assert!(!scavenged_cards.is_empty());
+            }
+            other => panic!("unexpected state after scavenge: {:?}", other),
+        }
     }
 
     #[test]
@@ -700,6 +864,108 @@ mod tests {
         assert_eq!(resp.status(), StatusCode::BAD_REQUEST);
     }
 
+    #[test]
+    fn test_batch_join_lobby() {
+        let test = TestServer::new();
+
+        // 2 players join the lobby in a single batch
+        let join_lobby =
+            "{\"method\": \"POST\", \"path\": \"/lobby\", \"body\": {\"min_game_size\": 2, \"max_game_size\": 4}}";
+        let resp = test.batch(vec![join_lobby, join_lobby]);
+        assert_eq!(resp.status(), StatusCode::OK);
+
+        // the responses are in the same order as the requests, as if they were sent one by one
+        let resp: BatchResponse = parse_response(resp);
+        assert_eq!(resp.responses.len(), 2);
+
+        // so the first player is waiting in the lobby
+        assert_eq!(resp.responses[0].status, StatusCode::CREATED.as_u16());
+        assert_eq!(
+            resp.responses[0].location,
+            Some(String::from("/lobby/players/0/game"))
+        );
+        let lobby_player: JoinedLobbyResponse =
+            serde_json::from_value(resp.responses[0].body.clone().unwrap()).unwrap();
+        assert_eq!(lobby_player.player_id_in_lobby, 0);
+
+        // and the second player is assigned to a game right away
+        assert_eq!(resp.responses[1].status, StatusCode::CREATED.as_u16());
+        let game_player: JoinedGameResponse =
+            serde_json::from_value(resp.responses[1].body.clone().unwrap()).unwrap();
+        assert_eq!(game_player.game_id, 0);
+        assert_eq!(game_player.player_id_in_game, 1);
+    }
+
+    #[test]
+    fn test_batch_with_token() {
+        let test = TestServer::new();
+
+        // 2 players join the lobby, which starts a game
+        let lobby_player: JoinedLobbyResponse = parse_response(test.join_lobby(2, 4));
+        let game_player: JoinedGameResponse = parse_response(test.join_lobby(2, 4));
+
+        // both players query their status in a single batch, using their own tokens
+        let get_lobby_player_status = format!(
+            "{{\"method\": \"GET\", \"path\": \"/lobby/players/{:?}/game\", \"token\": \"{}\"}}",
+            lobby_player.player_id_in_lobby, lobby_player.token
+        );
+        let get_private_card = format!(
+            "{{\"method\": \"GET\", \"path\": \"/games/{:?}/players/{:?}/private\", \"token\": \"{}\"}}",
+            game_player.game_id,
+            game_player.player_id_in_game,
+            game_player.token.unwrap()
+        );
+        let resp: BatchResponse = parse_response(test.batch(vec![
+            get_lobby_player_status.as_str(),
+            get_private_card.as_str(),
+        ]));
+
+        assert_eq!(
+            resp.responses[0].status,
+            StatusCode::TEMPORARY_REDIRECT.as_u16()
+        );
+        assert_eq!(
+            resp.responses[0].location,
+            Some(String::from("/games/0/players/0/private"))
+        );
+        assert_eq!(resp.responses[1].status, StatusCode::OK.as_u16());
+        serde_json::from_value::<PrivateCardResponse>(resp.responses[1].body.clone().unwrap())
+            .unwrap();
+    }
+
+    #[test]
+    fn test_batch_invalid_sub_requests() {
+        let test = TestServer::new();
+
+        let resp: BatchResponse = parse_response(test.batch(vec![
+            // a path that does not exist
+            "{\"method\": \"GET\", \"path\": \"/notfound\"}",
+            // batches cannot be nested
+            "{\"method\": \"POST\", \"path\": \"/batch\", \"body\": {\"requests\": []}}",
+            // not a valid path
+            "{\"method\": \"GET\", \"path\": \"not a path\"}",
+            // an invalid body
+            "{\"method\": \"POST\", \"path\": \"/lobby\", \"body\": {\"max_game_size\": 4}}",
+            // the rest of the batch is still processed
+            "{\"method\": \"POST\", \"path\": \"/lobby\", \"body\": {\"min_game_size\": 2, \"max_game_size\": 4}}",
+        ]));
+
+        assert_eq!(resp.responses[0].status, StatusCode::NOT_FOUND.as_u16());
+        assert_eq!(resp.responses[1].status, StatusCode::NOT_FOUND.as_u16());
+        assert_eq!(resp.responses[2].status, StatusCode::BAD_REQUEST.as_u16());
+
+        // the explanation of what's wrong is returned as a string
+        assert_eq!(resp.responses[3].status, StatusCode::BAD_REQUEST.as_u16());
+        assert!(resp.responses[3]
+            .body
+            .as_ref()
+            .and_then(|body| body.as_str())
+            .unwrap()
+            .contains("min_game_size"));
+
+        assert_eq!(resp.responses[4].status, StatusCode::CREATED.as_u16());
+    }
+
     // logic test helpers
     struct TestServer {
         lobby: Arc<Lobby>,
@@ -772,6 +1038,16 @@ mod tests {
                 Arc::clone(&self.game_manager),
             )
         }
+
+        fn batch(&self, sub_requests: Vec<&str>) -> Response<Body> {
+            post(
+                "/batch",
+                None,
+                format!("{{\"requests\": [{}]}}", sub_requests.join(", ")),
+                Arc::clone(&self.lobby),
+                Arc::clone(&self.game_manager),
+            )
+        }
     }
 
     // http test helpers
@@ -1,30 +1,51 @@
 #!/usr/local/bin/python3
 
+import os
 import sys
-import requests
-from typing import Optional
-import jsonschema
-import json
-import copy
+from pathlib import Path
+import asyncio
+import httpx
+import orjson
+from typing import Dict, List, Optional, Union
+import fastjsonschema
 import logging
+import random
+import time
 
 
 class SchemaValidatorHelper:
 
     def __init__(self, schema_file: str):
-        self.schema = json.load(open(schema_file))
+        self.schema = orjson.loads(Path(schema_file).read_bytes())
+        # one validator per type, each referring to its definition from a copy of the root schema (so the references
+        # between the definitions can still be resolved), compiled into a Python function once since the schema
+        # doesn't change
+        self.validators = {}
+        for type_name in self.schema["definitions"]:
+            schema = {k: v for k, v in self.schema.items() if k != "oneOf"}
+            schema["$ref"] = f"#/definitions/{type_name}"
+            self.validators[type_name] = fastjsonschema.compile(schema)
 
     def validate(self, json, type_name: str):
-        schema = copy.deepcopy(self.schema)
-        del schema["oneOf"]
-        schema["$ref"] = f"#/definitions/{type_name}"
-        jsonschema.validate(json, schema)
+        self.validators[type_name](json)
+
+
+class NoopValidator:
+    """Used instead of `SchemaValidatorHelper` when validation is disabled, so that it costs nothing."""
+
+    def validate(self, json, type_name: str):
+        pass
+
+
+# the moves without parameters are always the same, so they are serialized only once
+SCAVENGE_BODY = orjson.dumps("Scavenge")
+ACCEPT_TRADE_BODY = orjson.dumps("TradeAccept")
 
 
 class PlayerActions:
     @staticmethod
     def scavenge():
-        return "Scavenge"
+        return SCAVENGE_BODY
 
     @staticmethod
     def finish_scavenge(game_description, index_to_pick: int = 0):
@@ -58,24 +79,29 @@ class PlayerActions:
 
     @staticmethod
     def accept_trade():
-        return "TradeAccept"
+        return ACCEPT_TRADE_BODY
 
 
 class PlayerGameState:
+    __slots__ = ("secret_card", "game_description")
 
     def __init__(self, secret_card):
         self.secret_card = secret_card
+        self.game_description = None
 
     def update_game_description(self, json):
         self.game_description = json
 
 
 class Player:
+    __slots__ = ("lobby_id", "token", "game_id", "player_id", "game_state", "urls", "auth_headers")
     lobby_id: Optional[int]
     token: str
     game_id: Optional[int]
     player_id: Optional[int]
     game_state: Optional[PlayerGameState]
+    urls: Dict[str, str]
+    auth_headers: Dict[str, str]
 
     def __init__(self, lobby_id: Optional[int], game_id: Optional[int], player_id: Optional[int], token: str):
         self.lobby_id = lobby_id
@@ -83,69 +109,187 @@ class Player:
         self.game_id = game_id
         self.player_id = player_id
         self.game_state = None
+        self.auth_headers = {"Authorization": token}
+        self.bind_urls()
+
+    def bind_urls(self):
+        """Builds the URLs of the endpoints of this player (relative to the server). Call again when the IDs change."""
+        self.urls = {}
+        if self.lobby_id is not None:
+            self.urls["game_check"] = f"/lobby/players/{self.lobby_id}/game"
+        if self.game_id is not None:
+            self.urls["private"] = f"/games/{self.game_id}/players/{self.player_id}/private"
+            self.urls["moves"] = f"/games/{self.game_id}/players/{self.player_id}/moves"
+            self.urls["game"] = f"/games/{self.game_id}"
+
+
+class OrjsonClient(httpx.AsyncClient):
+    """An `httpx.AsyncClient` that serializes the `json` request bodies with orjson instead of the standard library."""
+
+    def build_request(self, method, url, *, json=None, **kwargs) -> httpx.Request:
+        if json is not None:
+            kwargs["content"] = orjson.dumps(json)
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), "Content-Type": "application/json"}
+        return super().build_request(method, url, **kwargs)
 
 
 class Backend:
     server: str
-
-    def __init__(self, server: str, schema: SchemaValidatorHelper):
+    # not seeded from the time, so concurrently started testers do not share the jitter sequence
+    jitter = random.SystemRandom()
+    # how to build the player from the join lobby response, by the key that tells the kinds of responses apart
+    PLAYER_BUILDERS = {
+        "player_id_in_lobby": lambda response_json: Player(
+            lobby_id=response_json["player_id_in_lobby"],
+            game_id=None,
+            player_id=None,
+            token=response_json["token"]),
+        "player_id_in_game": lambda response_json: Player(
+            lobby_id=None,
+            game_id=response_json["game_id"],
+            player_id=response_json["player_id_in_game"],
+            token=response_json["token"]),
+    }
+
+    def __init__(self, server: str, schema: Union[SchemaValidatorHelper, NoopValidator], http2: bool = False):
         self.server = server
         self.schema = schema
-
-    def join_lobby(self, min_game_size: int, max_game_size: int) -> Player:
-        request_json = {"min_game_size": min_game_size,
-                        "max_game_size": max_game_size}
-        schema.validate(request_json, "join_lobby_request")
-        resp = requests.post(f"http://{self.server}/lobby",
-                             json=request_json,
-                             allow_redirects=False)
+        # all the endpoints are on the same host, so a single client keeps the connections alive between calls.
+        # with `http2` the client talks HTTP/2 with prior knowledge (the server accepts that without TLS), so the
+        # concurrent requests are multiplexed on a single connection
+        self.client = OrjsonClient(base_url=f"http://{server}",
+                                   http1=not http2,
+                                   http2=http2,
+                                   limits=httpx.Limits(max_keepalive_connections=8))
+        # the pre-serialized moves are not validated when they are sent, so validate them here once
+        for body in (SCAVENGE_BODY, ACCEPT_TRADE_BODY):
+            self.schema.validate(orjson.loads(body), "player_action")
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def send(self, method: str, path: str, body=None, **kwargs) -> httpx.Response:
+        """Sends a request with `body` (if any) as JSON. `bytes` bodies are already serialized."""
+        if isinstance(body, bytes):
+            kwargs["headers"] = {**kwargs.get("headers", {}), "Content-Type": "application/json"}
+            return await self.client.request(method, path, content=body, **kwargs)
+        return await self.client.request(method, path, json=body, **kwargs)
+
+    async def join_lobby(self, min_game_size: int, max_game_size: int) -> Player:
+        request_json = self.join_lobby_request(min_game_size, max_game_size)
+        resp = await self.send("POST", "/lobby", request_json, follow_redirects=False)
 
         if resp.status_code == 201:
-            response_json = resp.json()
-            schema.validate(response_json, "join_lobby_response")
-            if "player_id_in_lobby" in response_json:
-                return Player(
-                    lobby_id=response_json["player_id_in_lobby"],
-                    game_id=None,
-                    player_id=None,
-                    token=response_json["token"])
-            elif "player_id_in_game" in response_json:
-                return Player(
-                    lobby_id=None,
-                    game_id=response_json["game_id"],
-                    player_id=response_json["player_id_in_game"],
-                    token=response_json["token"])
+            return self.to_player(orjson.loads(resp.content))
 
         raise(Backend.to_error("join lobby", resp))
 
-    def check_for_game(self, player: Player) -> bool:
+    async def join_lobby_together(self, num_players: int, min_game_size: int, max_game_size: int) -> List[Player]:
+        """Joins the lobby with `num_players` players at once, in a single batch."""
+        request_json = self.join_lobby_request(min_game_size, max_game_size)
+        responses = await self.batch([{"method": "POST", "path": "/lobby", "body": request_json}] * num_players)
+
+        players = []
+        for response in responses:
+            if response["status"] != 201:
+                raise(Backend.to_batch_error("join lobby", response))
+            players.append(self.to_player(response["body"]))
+        return players
+
+    def join_lobby_request(self, min_game_size: int, max_game_size: int):
+        request_json = {"min_game_size": min_game_size,
+                        "max_game_size": max_game_size}
+        self.schema.validate(request_json, "join_lobby_request")
+        return request_json
+
+    def to_player(self, response_json) -> Player:
+        self.schema.validate(response_json, "join_lobby_response")
+        kind = next((k for k in Backend.PLAYER_BUILDERS if k in response_json), None)
+        if kind is None:
+            raise(Exception(f"failed to join lobby: unexpected response: {response_json}"))
+        return Backend.PLAYER_BUILDERS[kind](response_json)
+
+    async def batch(self, requests):
+        """Sends the requests to the server in a single round trip, and returns the responses in the same order.
+
+        The requests are `batch_sub_request`s, and the responses are `batch_sub_response`s. If the server does not
+        support batching, the requests are sent one by one instead.
+        """
+        request_json = {"requests": requests}
+        self.schema.validate(request_json, "batch_request")
+        resp = await self.send("POST", "/batch", request_json)
+
+        if resp.status_code == 200:
+            response_json = orjson.loads(resp.content)
+            self.schema.validate(response_json, "batch_response")
+            return response_json["responses"]
+        elif resp.status_code == 404:
+            return [await self.send_batch_sub_request(request) for request in requests]
+
+        raise(Backend.to_error("send batch", resp))
+
+    async def send_batch_sub_request(self, request):
+        headers = {"Authorization": request["token"]} if "token" in request else {}
+        resp = await self.send(request["method"], request["path"], request.get("body"),
+                               headers=headers,
+                               follow_redirects=False)
+
+        response = {"status": resp.status_code}
+        if "Location" in resp.headers:
+            response["location"] = resp.headers["Location"]
+        if resp.content:
+            try:
+                response["body"] = orjson.loads(resp.content)
+            except ValueError:
+                response["body"] = resp.text
+        return response
+
+    async def check_for_game(self, player: Player) -> bool:
         if player.lobby_id is not None:
-            resp = requests.get(
-                f"http://{self.server}/lobby/players/{player.lobby_id}/game",
-                headers={"Authorization": player.token},
-                allow_redirects=False)
+            resp = await self.client.get(
+                player.urls["game_check"],
+                headers=player.auth_headers,
+                follow_redirects=False)
             if resp.status_code == 404:
                 return False
             elif resp.status_code == 307:
-                response_json = resp.json()
-                schema.validate(response_json, "found_game_response")
+                response_json = orjson.loads(resp.content)
+                self.schema.validate(response_json, "found_game_response")
                 if "player_id_in_game" in response_json:
                     player.game_id = response_json["game_id"]
                     player.player_id = response_json["player_id_in_game"]
+                    player.bind_urls()
                     return True
 
             raise(Backend.to_error("check for game", resp))
         else:
             raise(Exception("tried to check for game on player not in lobby"))
 
-    def check_secret_card(self, player: Player):
+    async def wait_for_game(self, player: Player, max_wait_s: float = 10.0, max_attempts: int = 10,
+                            base_delay_s: float = 0.05, max_delay_s: float = 2.0):
+        """Polls `check_for_game` until the player has a game, backing off exponentially between the attempts.
+
+        The delays are "full jitter" (uniformly random between 0 and the exponential delay), so that testers started
+        at the same time do not keep polling in lockstep.
+        """
+        deadline = time.monotonic() + max_wait_s
+        for attempt in range(max_attempts):
+            if await self.check_for_game(player):
+                return
+            delay = Backend.jitter.uniform(0, min(max_delay_s, base_delay_s * 2 ** attempt))
+            if attempt + 1 == max_attempts or time.monotonic() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+        raise(Exception(f"lobby player {player.lobby_id} did not get a game after {attempt + 1} attempts"))
+
+    async def check_secret_card(self, player: Player):
         if player.game_id is not None:
-            resp = requests.get(
-                f"http://{self.server}/games/{player.game_id}/players/{player.player_id}/private",
-                headers={"Authorization": player.token})
+            resp = await self.client.get(
+                player.urls["private"],
+                headers=player.auth_headers)
             if resp.status_code == 200:
-                response_json = resp.json()
-                schema.validate(response_json, "player_private_response")
+                response_json = orjson.loads(resp.content)
+                self.schema.validate(response_json, "player_private_response")
                 state = PlayerGameState(
                     secret_card=response_json["missing_part"])
                 player.game_state = state
@@ -154,27 +298,31 @@ class Backend:
         else:
             raise(Exception("tried to check for secret card on player not in a game"))
 
-    def make_move(self, player: Player, move):
+    async def make_move(self, player: Player, move):
         if player.game_state is not None:
-            schema.validate(move, "player_action")
-            resp = requests.post(
-                f"http://{self.server}/games/{player.game_id}/players/{player.player_id}/moves",
-                json=move,
-                headers={"Authorization": player.token})
+            if not isinstance(move, bytes):
+                self.schema.validate(move, "player_action")
+            resp = await self.send(
+                "POST",
+                player.urls["moves"],
+                move,
+                headers=player.auth_headers)
             if resp.status_code == 200:
-                self.refresh_game_state(player)
-                return
+                response_json = orjson.loads(resp.content)
+                self.schema.validate(response_json, "game_description")
+                player.game_state.update_game_description(response_json)
+                return response_json
             raise(Backend.to_error("make a move", resp))
         else:
             raise(Exception("tried to make move with player without a game state"))
 
-    def refresh_game_state(self, player: Player):
+    async def refresh_game_state(self, player: Player):
         if player.game_state is not None:
             # this endpoint is public
-            resp = requests.get(f"http://{self.server}/games/{player.game_id}")
+            resp = await self.client.get(player.urls["game"])
             if resp.status_code == 200:
-                response_json = resp.json()
-                schema.validate(response_json, "game_description")
+                response_json = orjson.loads(resp.content)
+                self.schema.validate(response_json, "game_description")
                 player.game_state.update_game_description(response_json)
                 return
             raise(Backend.to_error("get game state", resp))
@@ -182,16 +330,31 @@ class Backend:
             raise(Exception("tried to get game state for player without a game state"))
 
     @classmethod
-    def to_error(cls, operation: str, resp: requests.Response) -> Exception:
+    def to_error(cls, operation: str, resp: httpx.Response) -> Exception:
         return Exception(f"failed to {operation}: unexpected response: {resp.status_code}: {resp.text}")
 
+    @classmethod
+    def to_batch_error(cls, operation: str, response) -> Exception:
+        return Exception(f"failed to {operation}: unexpected response: {response['status']}: {response.get('body')}")
+
+
+async def scavenge_chain(backend: Backend, user: Player):
+    scavenge_response = await backend.make_move(user, PlayerActions.scavenge())
+    await backend.make_move(
+        user, PlayerActions.finish_scavenge(scavenge_response))
+
 
-def join_2_players_scavenge_trade(backend: Backend):
-    user1 = backend.join_lobby(2, 4)
-    user2 = backend.join_lobby(2, 4)
-    backend.check_for_game(user1)
-    if user1.game_id is None:
-        raise(Exception("user1 did not have after the second user joined"))
+async def join_2_players_scavenge_trade(backend: Backend):
+    users = await backend.join_lobby_together(2, 2, 4)
+    for user in users:
+        if user.game_id is None:
+            await backend.wait_for_game(user)
+
+    assert users[0].player_id is not None
+    assert users[1].player_id is not None
+
+    # player 0 makes the first move, so make sure that's user1
+    user1, user2 = sorted(users, key=lambda user: user.player_id)
 
     print(f"user1 in game {user1.game_id} (player {user1.player_id})")
     print(f"user2 in game {user2.game_id} (player {user2.player_id})")
@@ -199,36 +362,36 @@ def join_2_players_scavenge_trade(backend: Backend):
         raise(Exception(
             "the 2 users are in different games (this is a deficiency of the testing tool)"))
 
-    assert user1.player_id is not None
-    assert user2.player_id is not None
-
-    backend.check_secret_card(user1)
+    await asyncio.gather(backend.check_secret_card(user1), backend.check_secret_card(user2))
     if user1.game_state is None:
         raise(Exception("user1 did not have a secret card after checking"))
     print(f"user1 secret card: {user1.game_state.secret_card}")
-    backend.check_secret_card(user2)
     if user2.game_state is None:
         raise(Exception("user2 did not have a secret card after checking"))
     print(f"user2 secret card: {user2.game_state.secret_card}")
 
     # do a scavenge each so that they get some cards
+    # (these can't be done concurrently, since the players have to take turns. the response to each move has the new
+    # game state, so there's no need to get it in between)
 
-    backend.make_move(user1, PlayerActions.scavenge())
-    backend.make_move(
-        user1, PlayerActions.finish_scavenge(user1.game_state.game_description))
-
-    backend.make_move(user2, PlayerActions.scavenge())
-    backend.make_move(
-        user2, PlayerActions.finish_scavenge(user2.game_state.game_description))
+    await scavenge_chain(backend, user1)
+    await scavenge_chain(backend, user2)
 
     # then do a trade so that we also exercise the trade state validation
 
-    # (this is needed because player2's card is not reflected in the game state yet)
-    backend.refresh_game_state(user1)
+    # (this is needed because player2's card is not reflected in user1's game state yet)
+    await backend.refresh_game_state(user1)
 
-    backend.make_move(user1, PlayerActions.trade(
+    await backend.make_move(user1, PlayerActions.trade(
         user1.game_state.game_description, offering_player=user1.player_id, with_player=user2.player_id))
-    backend.make_move(user2, PlayerActions.accept_trade())
+    await backend.make_move(user2, PlayerActions.accept_trade())
+
+
+async def main(backend: Backend):
+    try:
+        await join_2_players_scavenge_trade(backend)
+    finally:
+        await backend.close()
 
 
 if __name__ == '__main__':
@@ -238,21 +401,27 @@ if __name__ == '__main__':
     if len(sys.argv) > 3:
         request_debug_logging = sys.argv[3]
     print("running against server", server)
-    print("validating against schema", schema_file)
-    schema = SchemaValidatorHelper(schema_file)
-    backend = Backend(server, schema)
+    if os.environ.get("MISSINGPARTS_VALIDATE") == "1":
+        print("validating against schema", schema_file)
+        schema = SchemaValidatorHelper(schema_file)
+    else:
+        print("not validating against the schema (set MISSINGPARTS_VALIDATE=1 to enable)")
+        schema = NoopValidator()
+    backend = Backend(server, schema, http2=os.environ.get("MISSINGPARTS_HTTP2") == "1")
 
     if request_debug_logging == 'request_debug':
-        try:
-            import http.client as http_client
-        except ImportError:
-            # Python 2
-            import httplib as http_client
-        http_client.HTTPConnection.debuglevel = 1
         logging.basicConfig()
         logging.getLogger().setLevel(logging.DEBUG)
-        requests_log = logging.getLogger("requests.packages.urllib3")
-        requests_log.setLevel(logging.DEBUG)
-        requests_log.propagate = True
-
-    join_2_players_scavenge_trade(backend)
+        for logger_name in ("httpx", "httpcore"):
+            requests_log = logging.getLogger(logger_name)
+            requests_log.setLevel(logging.DEBUG)
+            requests_log.propagate = True
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        # uvloop is optional, the default event loop works too (just with more overhead per request)
+        pass
+
+    asyncio.run(main(backend))